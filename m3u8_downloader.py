@@ -1,18 +1,99 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import m3u8
+import json
 import os
 import re
+import shutil
+import subprocess
+import sys
+import threading
 import time
 import argparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextlib
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from html.parser import HTMLParser
 from urllib.parse import urljoin, urlparse
-from bs4 import BeautifulSoup
+
+# BeautifulSoup is optional, only used when the built-in parser finds nothing
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+# Prefer the C-based lxml parser for BeautifulSoup when it is installed
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+# Matches absolute m3u8 links, run directly on the raw response bytes
+M3U8_RE = re.compile(rb'https?://[^\s\'\"<>\(\)]+\.m3u8')
+
+# I/O-bound workers are cheap, scale with the CPU count but stay below 32
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Size of each write when saving and merging segments
+CHUNK_SIZE = 1024 * 1024  # 1MB
+
+# The last segments of a pass would leave workers idle, so they are fetched
+# with Range requests of RANGE_CHUNK_SIZE bytes that share the worker pool
+RANGE_CHUNK_SIZE = 4 * 1024 * 1024  # 4MB
+
+# Content-Range header of a 206 response, "bytes <start>-<end>/<total>"
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+
+# Segment list of the last playlist downloaded into the output directory,
+# used to revalidate the playlist and to tell whether its segments can be reused
+PLAYLIST_CACHE_FILE = ".playlist.json"
+
+# Every MPEG-TS packet is 188 bytes long and starts with this sync byte
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = b'\x47'
+
+# Seconds between two progress updates, speed is averaged over the last
+# PROGRESS_WINDOW updates rather than since the start of the download
+PROGRESS_INTERVAL = 0.25
+PROGRESS_WINDOW = 16
+
+# Maximum number of nested iframes followed when looking for the m3u8 link
+MAX_IFRAME_DEPTH = 5
+
+class ScriptIframeParser(HTMLParser):
+    """Collect <script> bodies and <iframe> sources from an HTML page"""
+    
+    def __init__(self):
+        super().__init__()
+        self.scripts = []
+        self.iframes = []
+        self._in_script = False
+        
+    def handle_starttag(self, tag, attrs):
+        if tag == 'script':
+            self._in_script = True
+            self.scripts.append('')
+        elif tag == 'iframe':
+            src = dict(attrs).get('src')
+            if src:
+                self.iframes.append(src)
+                
+    def handle_endtag(self, tag):
+        if tag == 'script':
+            self._in_script = False
+            
+    def handle_data(self, data):
+        if self._in_script:
+            self.scripts[-1] += data
 
 class M3U8VideoDownloader:
     """M3U8 Video Downloader Class"""
     
     def __init__(self, url, output_dir="downloaded_video", output_file="output.mp4", 
-                 max_workers=10, retry_times=3, timeout=15, quiet=False):
+                 max_workers=DEFAULT_WORKERS, retry_times=3, timeout=15, quiet=False,
+                 max_per_host=None):
         """Initialize the downloader"""
         self.url = url
         self.output_dir = output_dir
@@ -21,12 +102,41 @@ class M3U8VideoDownloader:
         self.retry_times = retry_times
         self.timeout = timeout
         self.quiet = quiet
+        self.max_per_host = max_per_host
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
         }
         self.total_segments = 0
         self.completed_segments = 0
         self.start_time = 0
+        self._progress_lock = threading.Lock()
+        self._host_limits = {}
+        self._host_lock = threading.Lock()
+        
+        # Shared session so TS requests reuse pooled keep-alive connections,
+        # failed requests are retried with exponential backoff by urllib3
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        retries = Retry(total=self.retry_times,
+                        backoff_factor=0.5,
+                        status_forcelist=(429, 500, 502, 503, 504),
+                        allowed_methods=('GET', 'HEAD'),
+                        respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=self.max_workers,
+                              pool_maxsize=self.max_workers * 2,
+                              max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        
+    def close(self):
+        """Close the underlying HTTP session"""
+        self.session.close()
         
     def log(self, message):
         """Log output"""
@@ -39,112 +149,443 @@ class M3U8VideoDownloader:
             
     def find_m3u8_url(self):
         """Find the m3u8 link from the playback page"""
-        self.log(f"Analyzing the playback page: {self.url}")
+        url = self.url
+        depth = 0
         
         try:
-            # Add Referer header to simulate browser behavior
-            self.headers['Referer'] = self.url
-            response = requests.get(self.url, headers=self.headers, timeout=self.timeout)
-            response.raise_for_status()
-            
-            # Method 1: Use regular expressions to directly find the m3u8 link
-            m3u8_pattern = r'(https?://[^\s\'\"<>\(\)]+\.m3u8)'
-            matches = re.findall(m3u8_pattern, response.text)
-            if matches:
-                m3u8_url = matches[0]
-                self.log(f"Found m3u8 link: {m3u8_url}")
-                return m3u8_url
-            
-            # Method 2: Use BeautifulSoup to parse the page
-            soup = BeautifulSoup(response.text, 'html.parser')
-            script_tags = soup.find_all('script')
-            for script in script_tags:
-                if script.string:
-                    if '.m3u8' in script.string:
-                        # Try to extract the m3u8 link from JavaScript code
-                        matches = re.findall(m3u8_pattern, script.string)
-                        if matches:
-                            m3u8_url = matches[0]
-                            self.log(f"Found m3u8 link from script tag: {m3u8_url}")
-                            return m3u8_url
-            
-            # Method 3: Analyze embedded iframes
-            iframe_tags = soup.find_all('iframe')
-            for iframe in iframe_tags:
-                src = iframe.get('src')
-                if src:
-                    iframe_url = urljoin(self.url, src)
-                    self.log(f"Found iframe: {iframe_url}, trying to analyze...")
-                    # Recursively find the m3u8 link in the iframe
-                    self.url = iframe_url
-                    return self.find_m3u8_url()
-            
-            self.error("Could not find the m3u8 link on the page")
-            return None
+            # Follow nested iframes iteratively, reusing the session's connections
+            while True:
+                m3u8_url, iframe_url = self._scan_page(url)
+                if m3u8_url:
+                    return m3u8_url
+                if not iframe_url:
+                    self.error("Could not find the m3u8 link on the page")
+                    return None
+                if depth == MAX_IFRAME_DEPTH:
+                    self.error(f"Gave up after following {MAX_IFRAME_DEPTH} nested iframes, not analyzing {iframe_url}")
+                    return None
+                
+                self.log(f"Found iframe: {iframe_url}, trying to analyze...")
+                url = iframe_url
+                depth += 1
             
         except Exception as e:
             self.error(f"Failed to analyze the playback page: {e}")
             return None
     
-    def download_ts(self, ts_url, output_path, retry=0):
-        """Download a single TS segment"""
+    def _scan_page(self, url):
+        """Scan one page, return (m3u8_url, iframe_url) with at most one of them set"""
+        self.log(f"Analyzing the playback page: {url}")
+        
+        # Add Referer header to simulate browser behavior
+        self.session.headers['Referer'] = url
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        
+        # Method 1: Use regular expressions to directly find the m3u8 link
+        match = M3U8_RE.search(response.content)
+        if match:
+            # Decode like response.text would, the page is not necessarily UTF-8
+            try:
+                m3u8_url = match.group(0).decode(response.encoding or 'utf-8', errors='replace')
+            except (LookupError, TypeError):
+                # Unknown charset in the Content-Type header
+                m3u8_url = match.group(0).decode('utf-8', errors='replace')
+            self.log(f"Found m3u8 link: {m3u8_url}")
+            return m3u8_url, None
+        
+        # Method 2: Extract <script> and <iframe> tags with the built-in HTML parser
+        parser = ScriptIframeParser()
+        parser.feed(response.text)
+        parser.close()
+        scripts = [script for script in parser.scripts if '.m3u8' in script]
+        iframes = parser.iframes
+        
+        # Method 3: Fall back to BeautifulSoup when the built-in parser finds nothing
+        if not scripts and not iframes and BeautifulSoup is not None:
+            soup = BeautifulSoup(response.text, HTML_PARSER)
+            scripts = [tag.string for tag in soup.find_all('script', string=lambda s: s and '.m3u8' in s)]
+            iframes = [tag.get('src') for tag in soup.find_all('iframe') if tag.get('src')]
+        
+        for script in scripts:
+            # Try to extract the m3u8 link from JavaScript code
+            match = M3U8_RE.search(script.encode())
+            if match:
+                m3u8_url = match.group(0).decode(errors='replace')
+                self.log(f"Found m3u8 link from script tag: {m3u8_url}")
+                return m3u8_url, None
+        
+        # Analyze embedded iframes
+        if iframes:
+            return None, urljoin(url, iframes[0])
+        
+        return None, None
+    
+    def host_slot(self, url):
+        """Return a context that limits concurrent requests to the url's host"""
+        if not self.max_per_host:
+            return contextlib.nullcontext()
+        
+        host = urlparse(url).netloc
+        with self._host_lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_limits[host]
+    
+    def download_ts(self, ts_url, output_path):
+        """Download a single TS segment, transient errors are retried by the session"""
         try:
-            if retry > 0:
-                self.log(f"Retrying to download {ts_url} ({retry}/{self.retry_times})")
+            with self.host_slot(ts_url):
+                with self.session.get(ts_url, timeout=self.timeout, stream=True) as response:
+                    response.raise_for_status()
+                    self.save_response(response, output_path)
             
-            response = requests.get(ts_url, headers=self.headers, timeout=self.timeout, stream=True)
-            response.raise_for_status()
+            with self._progress_lock:
+                self.completed_segments += 1
             
-            with open(output_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=1024*1024):  # 1MB chunk
-                    if chunk:
-                        f.write(chunk)
+            return True
             
-            self.completed_segments += 1
-            elapsed = time.time() - self.start_time
-            speed = self.completed_segments / elapsed if elapsed > 0 else 0
-            eta = (self.total_segments - self.completed_segments) / speed if speed > 0 else 0
+        except Exception as e:
+            self.error(f"Failed to download {ts_url}: {e}")
+            return False
+    
+    def save_response(self, response, output_path):
+        """Stream a segment response body into output_path"""
+        # TS is already binary, only decode if the server compressed it anyway
+        response.raw.decode_content = 'Content-Encoding' in response.headers
+        
+        # Write to a temporary file so an interrupted download never looks complete
+        part_path = output_path + '.part'
+        with open(part_path, 'wb') as f:
+            self.preallocate(f, response)
+            shutil.copyfileobj(response.raw, f, length=CHUNK_SIZE)
+            f.truncate()  # Drop preallocated space a short body did not fill
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(part_path, output_path)
+    
+    def preallocate(self, f, response):
+        """Reserve contiguous disk space for a segment whose size is known (Linux only)"""
+        size = response.headers.get('Content-Length')
+        if not size or 'Content-Encoding' in response.headers or not hasattr(os, 'posix_fallocate'):
+            return
+        try:
+            os.posix_fallocate(f.fileno(), 0, int(size))
+        except (OSError, ValueError):
+            pass  # The allocation is only a hint, the download works without it
+    
+    def download_first_range(self, ts_url, output_path):
+        """Download the first range of a segment, return its size if more ranges are needed"""
+        # 0 means the whole segment was saved (it is small, or the server ignores
+        # Range), None means the download failed
+        try:
+            headers = {'Range': f'bytes=0-{RANGE_CHUNK_SIZE - 1}', 'Accept-Encoding': 'identity'}
+            with self.host_slot(ts_url):
+                with self.session.get(ts_url, headers=headers, timeout=self.timeout,
+                                      stream=True) as response:
+                    response.raise_for_status()
+                    match = CONTENT_RANGE_RE.fullmatch(response.headers.get('Content-Range', ''))
+                    start, end, total = map(int, match.groups()) if match else (-1, -1, -1)
+                    if start == 0 and end == RANGE_CHUNK_SIZE - 1 and total > RANGE_CHUNK_SIZE:
+                        self.save_range(response, f"{output_path}.part.0", RANGE_CHUNK_SIZE)
+                        return total
+                    
+                    # A 200 carries the whole segment, so does a 206 covering all of it
+                    whole = response.status_code == 200 or (start == 0 and end == total - 1)
+                    if whole:
+                        self.save_response(response, output_path)
             
-            progress = f"\rProgress: {self.completed_segments}/{self.total_segments} "
-            progress += f"[{(self.completed_segments/self.total_segments)*100:.2f}%] "
-            progress += f"Speed: {speed:.2f} segments/sec "
-            progress += f"ETA: {eta//60:.0f} min {eta%60:.0f} sec"
+            if not whole:
+                # The server sent some other range (servers may cap their size),
+                # fetch the segment without Range instead of piecing it together
+                return 0 if self.download_ts(ts_url, output_path) else None
             
-            if not self.quiet:
-                print(progress, end='', flush=True)
+            with self._progress_lock:
+                self.completed_segments += 1
+            return 0
             
+        except Exception as e:
+            if os.path.exists(f"{output_path}.part.0"):
+                os.remove(f"{output_path}.part.0")
+            self.error(f"Failed to download {ts_url}: {e}")
+            return None
+    
+    def download_range(self, ts_url, byte_range, range_path):
+        """Download one byte range of a TS segment into range_path"""
+        start, end = byte_range
+        try:
+            headers = {'Range': f'bytes={start}-{end}', 'Accept-Encoding': 'identity'}
+            with self.host_slot(ts_url):
+                with self.session.get(ts_url, headers=headers, timeout=self.timeout,
+                                      stream=True) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        raise IOError(f"Server ignored the Range header for {ts_url}")
+                    self.save_range(response, range_path, end - start + 1)
             return True
             
         except Exception as e:
-            if retry < self.retry_times:
-                time.sleep(1 + retry)  # Exponential backoff
-                return self.download_ts(ts_url, output_path, retry + 1)
-            else:
-                self.error(f"Failed to download {ts_url}: {e}")
+            self.error(f"Failed to download bytes {start}-{end} of {ts_url}: {e}")
+            return False
+    
+    def save_range(self, response, range_path, length):
+        """Save a 206 response body, checking that the whole range arrived"""
+        with open(range_path, 'wb') as f:
+            shutil.copyfileobj(response.raw, f, length=CHUNK_SIZE)
+            if f.tell() != length:
+                raise IOError(f"Incomplete range, got {f.tell()} of {length} bytes")
+    
+    def is_segment_complete(self, segment_path):
+        """Check that a segment file exists and looks like a complete MPEG-TS file"""
+        try:
+            if os.path.getsize(segment_path) <= TS_PACKET_SIZE:
                 return False
+            with open(segment_path, 'rb') as f:
+                return f.read(1) == TS_SYNC_BYTE
+        except OSError:
+            return False
+    
+    def print_progress(self, samples):
+        """Print the current download progress on a single line"""
+        now = time.time()
+        completed = self.completed_segments
+        samples.append((now, completed))
+        
+        # Recent rate over the sliding window of (timestamp, completed) samples
+        first_time, first_completed = samples[0]
+        elapsed = now - first_time
+        speed = (completed - first_completed) / elapsed if elapsed > 0 else 0
+        eta = (self.total_segments - completed) / speed if speed > 0 else 0
+        
+        progress = f"\rProgress: {completed}/{self.total_segments} "
+        progress += f"[{(completed/self.total_segments)*100:.2f}%] "
+        progress += f"Speed: {speed:.2f} segments/sec "
+        progress += f"ETA: {eta//60:.0f} min {eta%60:.0f} sec"
+        
+        print(progress, end='', flush=True)
+    
+    def _print_progress_loop(self, stop_event):
+        """Print the progress periodically until stop_event is set"""
+        samples = deque([(self.start_time, self.completed_segments)], maxlen=PROGRESS_WINDOW)
+        while not stop_event.wait(PROGRESS_INTERVAL):
+            self.print_progress(samples)
+        self.print_progress(samples)
     
-    def check_and_download_missing_segments(self, ts_urls):
-        """Check and download missing segments"""
-        missing_segments = []
-        for ts_url, index in ts_urls:
-            output_path = os.path.join(self.output_dir, f"segment_{index}.ts")
-            if not os.path.exists(output_path):
-                missing_segments.append((ts_url, index))
+    def download_segments(self, segments):
+        """Download (ts_url, index) pairs concurrently, return the failed ones"""
+        failed = []
+        ranged = {}  # (ts_url, index) -> [range count, ranges still running, all succeeded]
         
+        # The last max_workers segments would leave workers idle, so those are fetched
+        # by range and large ones are split further on the same pool
+        split_from = len(segments) - self.max_workers
+        
+        def collect(done):
+            for future in done:
+                kind, segment = futures.pop(future)
+                result = future.result()  # Get the result and trigger exceptions
+                ts_url, index = segment
+                output_path = os.path.join(self.output_dir, f"segment_{index}.ts")
+                
+                if kind == 'segment':
+                    if not result:
+                        failed.append(segment)
+                elif kind == 'first_range':
+                    if result is None:
+                        failed.append(segment)
+                    elif result:
+                        # Large segment, queue its remaining ranges behind the current work
+                        ranges = [(start, min(start + RANGE_CHUNK_SIZE, result) - 1)
+                                  for start in range(RANGE_CHUNK_SIZE, result, RANGE_CHUNK_SIZE)]
+                        ranged[segment] = [len(ranges) + 1, len(ranges), True]
+                        for k, byte_range in enumerate(ranges, 1):
+                            range_path = f"{output_path}.part.{k}"
+                            future = executor.submit(self.download_range, ts_url, byte_range, range_path)
+                            futures[future] = ('range', segment)
+                else:
+                    state = ranged[segment]
+                    state[1] -= 1
+                    state[2] = state[2] and result
+                    if state[1] == 0:
+                        del ranged[segment]
+                        if not self.finish_ranges(ts_url, output_path, state[0], state[2]):
+                            failed.append(segment)
+        
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+            for position, (ts_url, index) in enumerate(segments):
+                # Cap queued work so huge playlists do not hold a future per segment
+                if len(futures) >= self.max_workers * 2:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    collect(done)
+                
+                output_path = os.path.join(self.output_dir, f"segment_{index}.ts")
+                if position >= split_from:
+                    future = executor.submit(self.download_first_range, ts_url, output_path)
+                    futures[future] = ('first_range', (ts_url, index))
+                else:
+                    future = executor.submit(self.download_ts, ts_url, output_path)
+                    futures[future] = ('segment', (ts_url, index))
+            
+            # Wait for the remaining downloads, range requests may still be added
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                collect(done)
+        
+        return failed
+    
+    def finish_ranges(self, ts_url, output_path, count, ok):
+        """Join the downloaded ranges of a split segment, return whether it is complete"""
+        range_paths = [f"{output_path}.part.{k}" for k in range(count)]
+        try:
+            if not ok:
+                return False
+            
+            part_path = output_path + '.part'
+            with open(part_path, 'wb') as outfile:
+                for range_path in range_paths:
+                    self.append_segment(outfile, range_path)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(part_path, output_path)
+            
+            with self._progress_lock:
+                self.completed_segments += 1
+            return True
+            
+        except Exception as e:
+            self.error(f"Failed to join the ranges of {ts_url}: {e}")
+            return False
+            
+        finally:
+            for range_path in range_paths:
+                if os.path.exists(range_path):
+                    os.remove(range_path)
+    
+    def check_and_download_missing_segments(self, missing_segments):
+        """Download the failed segments once more, return the ones still missing"""
+        # Requests were already retried by the session, this single pass only covers
+        # failures it cannot retry, like a body cut off mid-stream or a broken range
         if missing_segments:
             self.log(f"Found {len(missing_segments)} missing segments, starting download...")
-            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-                futures = []
-                for ts_url, index in missing_segments:
-                    output_path = os.path.join(self.output_dir, f"segment_{index}.ts")
-                    futures.append(executor.submit(self.download_ts, ts_url, output_path))
-                
-                # Wait for all downloads to complete
-                for future in as_completed(futures):
-                    future.result()  # Get the result and trigger exceptions
+            missing_segments = self.download_segments(missing_segments)
+        
+        if missing_segments:
+            self.error(f"{len(missing_segments)} segments could not be downloaded")
+        return missing_segments
+    
+    def append_segment(self, outfile, segment_path):
+        """Append a segment to the merged file, copying inside the kernel where possible"""
+        with open(segment_path, 'rb') as infile:
+            # os.sendfile only accepts a file as destination and a None offset on Linux
+            if sys.platform.startswith('linux'):
+                outfile.flush()  # Kernel copies write at the raw file position
+                src, dst = infile.fileno(), outfile.fileno()
+                remaining = os.fstat(src).st_size
+                try:
+                    while remaining > 0:
+                        try:
+                            copied = os.copy_file_range(src, dst, remaining)
+                        except (AttributeError, OSError):
+                            copied = os.sendfile(dst, src, None, remaining)
+                        if copied == 0:
+                            break
+                        remaining -= copied
+                except OSError:
+                    pass
             
-            # Recursively check if there are still missing segments
-            self.check_and_download_missing_segments(ts_urls)
+            # Copy whatever the kernel did not in user space (everything off Linux)
+            shutil.copyfileobj(infile, outfile, length=CHUNK_SIZE)
+    
+    def merge_segments(self, output_path):
+        """Merge all downloaded segments into output_path"""
+        segment_paths = []
+        for i in range(self.total_segments):
+            segment_path = os.path.join(self.output_dir, f"segment_{i}.ts")
+            if os.path.exists(segment_path):
+                segment_paths.append(segment_path)
+            else:
+                self.error(f"Warning: Segment {i} does not exist")
+        
+        # Method 1: Remux with ffmpeg, raw TS bytes are not a valid MP4 container
+        use_ffmpeg = self.output_file.lower().endswith('.mp4') and shutil.which('ffmpeg')
+        if use_ffmpeg:
+            if self.merge_with_ffmpeg(segment_paths, output_path):
+                return True
+            self.error("Falling back to simple binary merge...")
+        
+        # Method 2: Simple binary merge (TS outputs, or ffmpeg is not installed)
+        try:
+            with open(output_path, 'wb') as outfile:
+                for segment_path in segment_paths:
+                    self.append_segment(outfile, segment_path)
+            
+            self.log(f"Video merged successfully: {output_path}")
+            return True
+            
+        except Exception as e:
+            self.error(f"Simple merge failed: {e}")
+            if not use_ffmpeg and shutil.which('ffmpeg'):
+                self.error("Trying a more professional merge method...")
+                return self.merge_with_ffmpeg(segment_paths, output_path)
+            self.error("Please try to merge the segments manually")
+            return False
+    
+    def merge_with_ffmpeg(self, segment_paths, output_path):
+        """Merge segments with the ffmpeg concat demuxer without re-encoding"""
+        try:
+            # Stream the concat list to ffmpeg's stdin instead of writing a list file.
+            # Entries need an explicit file: protocol, otherwise ffmpeg resolves them
+            # relative to the stdin URL (fd:) and cannot open them.
+            file_list = ''.join(
+                "file 'file:{}'\n".format(os.path.abspath(p).replace(os.sep, '/').replace("'", "'\\''"))
+                for p in segment_paths
+            )
+            cmd = [
+                'ffmpeg', 
+                '-y', 
+                '-f', 'concat', 
+                '-safe', '0', 
+                '-protocol_whitelist', 'file,pipe,fd', 
+                '-i', '-', 
+                '-c', 'copy', 
+                output_path
+            ]
+            
+            subprocess.run(cmd, input=file_list.encode(), check=True,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self.log(f"Merged using ffmpeg successfully: {output_path}")
+            return True
+            
+        except Exception as e:
+            self.error(f"ffmpeg merge failed: {e}")
+            return False
+    
+    def load_playlist_cache(self, m3u8_url):
+        """Load the cached playlist for m3u8_url, or return an empty dict"""
+        cache_path = os.path.join(self.output_dir, PLAYLIST_CACHE_FILE)
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return cache if cache.get('url') == m3u8_url else {}
+    
+    def save_playlist_cache(self, m3u8_url, response, ts_urls):
+        """Record the parsed segment list and the validators of the playlist response"""
+        cache = {
+            'url': m3u8_url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'urls': ts_urls,
+        }
+        
+        cache_path = os.path.join(self.output_dir, PLAYLIST_CACHE_FILE)
+        try:
+            with open(cache_path, 'w', encoding='utf-8') as f:
+                json.dump(cache, f)
+        except OSError as e:
+            self.error(f"Could not cache the playlist: {e}")
     
     def download_m3u8_video(self, m3u8_url=None):
         """Download and merge M3U8 videos"""
@@ -161,53 +602,66 @@ class M3U8VideoDownloader:
         
         try:
             # Add Referer header
-            self.headers['Referer'] = urljoin(m3u8_url, '/')
+            self.session.headers['Referer'] = urljoin(m3u8_url, '/')
             
-            response = requests.get(m3u8_url, headers=self.headers, timeout=self.timeout)
-            response.raise_for_status()
+            # Ask the server to confirm the playlist cached by a previous run is still current
+            cache = self.load_playlist_cache(m3u8_url)
+            headers = {}
+            if cache.get('etag'):
+                headers['If-None-Match'] = cache['etag']
+            if cache.get('last_modified'):
+                headers['If-Modified-Since'] = cache['last_modified']
             
-            # Parse the m3u8 file
-            m3u8_obj = m3u8.loads(response.text)
+            response = self.session.get(m3u8_url, headers=headers, timeout=self.timeout)
+            response.raise_for_status()
             
             # Create the save directory
             if not os.path.exists(self.output_dir):
                 os.makedirs(self.output_dir)
             
-            # Handle nested m3u8 files
-            if m3u8_obj.is_variant:
-                # Select the highest quality stream
-                playlists = sorted(m3u8_obj.playlists, 
-                                  key=lambda p: p.stream_info.bandwidth or 0, 
-                                  reverse=True)
+            if response.status_code == 304 and cache:
+                self.log("The M3U8 file is unchanged, using the cached segment list")
+                ts_urls = [tuple(ts) for ts in cache['urls']]
+            else:
+                # Parse the m3u8 file
+                m3u8_obj = m3u8.loads(response.text)
                 
-                self.log("Found multiple quality options:")
-                for i, playlist in enumerate(playlists):
-                    resolution = playlist.stream_info.resolution
-                    bandwidth = playlist.stream_info.bandwidth / 1000000 if playlist.stream_info.bandwidth else "Unknown"
-                    self.log(f"  {i+1}. Resolution: {resolution}, Bandwidth: {bandwidth:.2f} Mbps")
+                # Handle nested m3u8 files
+                if m3u8_obj.is_variant:
+                    # Select the highest quality stream
+                    playlists = sorted(m3u8_obj.playlists, 
+                                      key=lambda p: p.stream_info.bandwidth or 0, 
+                                      reverse=True)
+                    
+                    self.log("Found multiple quality options:")
+                    for i, playlist in enumerate(playlists):
+                        resolution = playlist.stream_info.resolution
+                        bandwidth = playlist.stream_info.bandwidth / 1000000 if playlist.stream_info.bandwidth else "Unknown"
+                        self.log(f"  {i+1}. Resolution: {resolution}, Bandwidth: {bandwidth:.2f} Mbps")
+                    
+                    # Automatically select the highest quality
+                    selected = playlists[0]
+                    self.log(f"Selected the highest quality: {selected.stream_info.resolution or 'Unknown'}")
+                    
+                    playlist_url = selected.uri
+                    if not playlist_url.startswith(('http:', 'https:')):
+                        playlist_url = urljoin(m3u8_url, playlist_url)
+                    
+                    return self.download_m3u8_video(playlist_url)
                 
-                # Automatically select the highest quality
-                selected = playlists[0]
-                self.log(f"Selected the highest quality: {selected.stream_info.resolution or 'Unknown'}")
+                # Extract all TS segments
+                base_url = m3u8_url.rsplit('/', 1)[0] + '/'
+                ts_urls = []
                 
-                playlist_url = selected.uri
-                if not playlist_url.startswith(('http:', 'https:')):
-                    playlist_url = urljoin(m3u8_url, playlist_url)
+                for i, segment in enumerate(m3u8_obj.segments):
+                    ts_url = segment.uri
+                    if not ts_url.startswith(('http:', 'https:')):
+                        ts_url = urljoin(base_url, ts_url)
+                    ts_urls.append((ts_url, i))
                 
-                return self.download_m3u8_video(playlist_url)
-            
-            # Extract all TS segments
-            base_url = m3u8_url.rsplit('/', 1)[0] + '/'
-            ts_urls = []
-            
-            for i, segment in enumerate(m3u8_obj.segments):
-                ts_url = segment.uri
-                if not ts_url.startswith(('http:', 'https:')):
-                    ts_url = urljoin(base_url, ts_url)
-                ts_urls.append((ts_url, i))
+                self.save_playlist_cache(m3u8_url, response, ts_urls)
             
             self.total_segments = len(ts_urls)
-            self.completed_segments = 0
             self.start_time = time.time()
             
             if self.total_segments == 0:
@@ -215,78 +669,51 @@ class M3U8VideoDownloader:
                 return False
             
             self.log(f"Found a total of {self.total_segments} video segments")
+            
+            # Segments completed by an earlier run are not downloaded again, but only
+            # when that run was for the same playlist, other files are overwritten
+            resume = bool(cache) and [tuple(ts) for ts in cache.get('urls', [])] == ts_urls
+            pending = []
+            for ts_url, index in ts_urls:
+                output_path = os.path.join(self.output_dir, f"segment_{index}.ts")
+                if not (resume and self.is_segment_complete(output_path)):
+                    pending.append((ts_url, index))
+            
+            self.completed_segments = self.total_segments - len(pending)
+            if self.completed_segments:
+                self.log(f"Skipping {self.completed_segments} segments already downloaded")
             self.log("Starting download...")
             
+            # Progress is printed by a single background thread instead of every worker
+            stop_progress = threading.Event()
+            progress_thread = None
+            if not self.quiet:
+                progress_thread = threading.Thread(target=self._print_progress_loop,
+                                                   args=(stop_progress,), daemon=True)
+                progress_thread.start()
+            
             # Multi-threaded download
-            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-                futures = []
-                for ts_url, index in ts_urls:
-                    output_path = os.path.join(self.output_dir, f"segment_{index}.ts")
-                    futures.append(executor.submit(self.download_ts, ts_url, output_path))
-                
-                # Wait for all downloads to complete
-                for future in as_completed(futures):
-                    future.result()  # Get the result and trigger exceptions
+            try:
+                failed = self.download_segments(pending)
+            finally:
+                stop_progress.set()
+                if progress_thread:
+                    progress_thread.join()
             
             print()  # New line
             
             # Check and download missing segments
-            self.check_and_download_missing_segments(ts_urls)
+            if self.check_and_download_missing_segments(failed):
+                self.error("Not merging an incomplete video, run the download again to resume")
+                return False
             
             self.log("All segments downloaded, starting to merge...")
             
             # Merge all TS files
             output_path = os.path.join(self.output_dir, self.output_file)
             
-            # Method 1: Simple binary merge (suitable for most cases)
-            try:
-                with open(output_path, 'wb') as outfile:
-                    for i in range(self.total_segments):
-                        segment_path = os.path.join(self.output_dir, f"segment_{i}.ts")
-                        if os.path.exists(segment_path):
-                            with open(segment_path, 'rb') as infile:
-                                outfile.write(infile.read())
-                        else:
-                            self.error(f"Warning: Segment {i} does not exist")
-                
-                self.log(f"Video merged successfully: {output_path}")
-                return True
-                
-            except Exception as e:
-                self.error(f"Simple merge failed: {e}")
-                self.error("Trying a more professional merge method...")
-                
-                # Method 2: Use ffmpeg to merge (ffmpeg needs to be installed)
-                try:
-                    import subprocess
-                    
-                    # Generate the merge list file
-                    list_file = os.path.join(self.output_dir, "filelist.txt")
-                    with open(list_file, 'w') as f:
-                        for i in range(self.total_segments):
-                            segment_path = os.path.join(self.output_dir, f"segment_{i}.ts")
-                            if os.path.exists(segment_path):
-                                f.write(f"file '{segment_path.replace(os.sep, '/')}'\n")
-                    
-                    # Execute the ffmpeg command
-                    cmd = [
-                        'ffmpeg', 
-                        '-f', 'concat', 
-                        '-safe', '0', 
-                        '-i', list_file, 
-                        '-c', 'copy', 
-                        output_path
-                    ]
-                    
-                    subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    self.log(f"Merged using ffmpeg successfully: {output_path}")
-                    return True
-                    
-                except Exception as e:
-                    self.error(f"ffmpeg merge failed: {e}")
-                    self.error("Please try to merge the segments manually")
-                    return False
-                    
+            return self.merge_segments(output_path)
+            
         except Exception as e:
             self.error(f"An error occurred during the download: {e}")
             return False
@@ -297,22 +724,24 @@ def main():
     parser.add_argument('url', help='Video playback page URL or m3u8 link')
     parser.add_argument('-o', '--output', default='output.mp4', help='Output file name')
     parser.add_argument('-d', '--directory', default='downloaded_video', help='Download directory')
-    parser.add_argument('-w', '--workers', type=int, default=10, help='Number of concurrent download threads')
-    parser.add_argument('-r', '--retries', type=int, default=3, help='Number of retries on download failure')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS, help='Number of concurrent download threads')
+    parser.add_argument('-r', '--retries', type=int, default=3, help='Number of retries per request, failed segments then get one more pass')
+    parser.add_argument('-p', '--per-host', type=int, default=None, help='Maximum concurrent requests per host, for rate-limited servers')
     parser.add_argument('-q', '--quiet', action='store_true', help='Quiet mode, do not display progress')
     
     args = parser.parse_args()
     
-    downloader = M3U8VideoDownloader(
+    with M3U8VideoDownloader(
         url=args.url,
         output_dir=args.directory,
         output_file=args.output,
         max_workers=args.workers,
         retry_times=args.retries,
-        quiet=args.quiet
-    )
+        quiet=args.quiet,
+        max_per_host=args.per_host
+    ) as downloader:
+        success = downloader.download_m3u8_video()
     
-    success = downloader.download_m3u8_video()
     if success:
         print("\n✅ Download successful!")
     else: